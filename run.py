@@ -2,6 +2,7 @@
 
 import os
 import sys
+import time
 import signal
 import logging
 import exif
@@ -11,6 +12,16 @@ import json
 import csv
 import re
 import math
+import bisect
+import heapq
+import zlib
+import socket
+import socketserver
+import threading
+import queue
+import asyncio
+import collections
+import concurrent.futures
 import plum
 
 log = logging.getLogger('EXIF Modifier')
@@ -27,13 +38,45 @@ log.addHandler(fh)
 
 
 EXIF_DATETIME_FORMAT = '%Y:%m:%d %H:%M:%S'
+DB_FORMAT = 'py_img_metadatafix'
+# 0: flat list of entries, 1: dict keyed on filename without header, 2: header with relative paths,
+# 3: entries sorted on filename and written one per line so the db can be streamed,
+# 4: exif dates also stored as validated timestamps
+DB_SCHEMA_VERSION = 4
+EPOCH = datetime.datetime(1970, 1, 1)
 IMAGE_EXTENSIONS = ['jpg', 'jpeg']
-IMG_FILENAME_REGEX = ".*-([0-9]{4})([0-9]{2})([0-9]{2})-.*"
+# camera sequence number in names like IMG_0123, DSC01234 or P1010001, dates like IMG_20190301 are no sequence
+SEQUENCE_REGEX = '^(?:IMG|DSC|DSCN|DSCF|_DSC|DCP|PICT|CIMG|GOPR|P)_?([0-9]{3,7})(?![0-9])'
+# the first pattern with a valid date anywhere in the name wins, patterns capturing a time of day
+# go before date only patterns
+FILENAME_DATE_PATTERNS = [
+    # WhatsApp Image 2020-05-01 at 10.11.12
+    r'(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2}) at '
+    r'(?P<hour>[0-9]{1,2})\.(?P<minute>[0-9]{2})\.(?P<second>[0-9]{2})',
+    # IMG_20190301_142233, PXL_20211224_101010123
+    r'(?<![0-9])(?P<year>[0-9]{4})(?P<month>[0-9]{2})(?P<day>[0-9]{2})[_-]'
+    r'(?P<hour>[0-9]{2})(?P<minute>[0-9]{2})(?P<second>[0-9]{2})',
+    # 2018-07-04 10.22.11, 2018-07-04_10-22-11
+    r'(?<![0-9])(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})[ _T]'
+    r'(?P<hour>[0-9]{2})[.:-](?P<minute>[0-9]{2})[.:-](?P<second>[0-9]{2})',
+    # something-20180704-something
+    r'-(?P<year>[0-9]{4})(?P<month>[0-9]{2})(?P<day>[0-9]{2})-',
+    # 2017-06-02 party
+    r'(?<![0-9])(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})(?![0-9])',
+    # IMG_20190301, 20190301
+    r'(?<![0-9])(?P<year>[0-9]{4})(?P<month>[0-9]{2})(?P<day>[0-9]{2})(?![0-9])',
+]
 
 
 class CleanExit(object):
-    def __init__(self):
-        signal.signal(signal.SIGINT, self.sigint_handler)
+    # while an owner (the daemon) holds SIGINT, other instances do not take the handler over
+    owned = False
+
+    def __init__(self, own=False):
+        if own:
+            CleanExit.owned = True
+        if own or not CleanExit.owned:
+            signal.signal(signal.SIGINT, self.sigint_handler)
         self.exit = False
 
     def sigint_handler(self, signal_received, _):
@@ -105,28 +148,309 @@ class PrettyProgress(object):
         print('', flush=True)
 
 
-class DirData(object):
+class PathIndex(object):
+    # directory trie over the db keys with a basename lookup table,
+    # dicts are used as ordered sets so iteration follows db order
+
     @classmethod
     def create_from_photo_db(cls, photo_db):
+        index = PathIndex()
+        for k in photo_db.keys():
+            index.add(k)
+        return index
+
+    @classmethod
+    def normalize(cls, dir_key):
+        dir_key = os.path.normpath(dir_key)
+        if dir_key in ['.', os.sep]:
+            return ''
+        return dir_key.strip(os.sep)
+
+    def __init__(self):
+        self.root = {'dirs': {}, 'files': {}}
+        self.basenames = {}
+
+    def node(self, dir_key, create=False):
+        node = self.root
+        if dir_key == '':
+            return node
+        for part in dir_key.split(os.sep):
+            if part not in node['dirs'].keys():
+                if not create:
+                    return None
+                node['dirs'][part] = {'dirs': {}, 'files': {}}
+            node = node['dirs'][part]
+        return node
+
+    def add(self, key):
+        self.node(os.path.dirname(key), create=True)['files'][key] = None
+        self.basenames.setdefault(os.path.basename(key), {})[key] = None
+
+    def remove(self, key):
+        path = [self.root]
+        dir_key = os.path.dirname(key)
+        if dir_key != '':
+            for part in dir_key.split(os.sep):
+                if part not in path[-1]['dirs'].keys():
+                    return
+                path.append(path[-1]['dirs'][part])
+        path[-1]['files'].pop(key, None)
+        # prune empty directories so subtree walks stay proportional to the result
+        parts = dir_key.split(os.sep) if dir_key != '' else []
+        while parts and not path[-1]['files'] and not path[-1]['dirs']:
+            path.pop()
+            path[-1]['dirs'].pop(parts.pop())
+
+        name = os.path.basename(key)
+        if name in self.basenames.keys():
+            self.basenames[name].pop(key, None)
+            if not self.basenames[name]:
+                self.basenames.pop(name)
+
+    def by_basename(self, name):
+        return list(self.basenames.get(name, {}).keys())
+
+    def walk(self, dir_key=''):
+        # yields (dir_key, files) top-down, parents before their subdirectories
+        dir_key = PathIndex.normalize(dir_key)
+        node = self.node(dir_key)
+        if node is None:
+            return
+        stack = [(dir_key, node)]
+        while stack:
+            dir_key, node = stack.pop()
+            yield dir_key, list(node['files'].keys())
+            for name in reversed(list(node['dirs'].keys())):
+                stack.append((os.path.join(dir_key, name), node['dirs'][name]))
+
+    def subtree(self, dir_key=''):
+        for _, files in self.walk(dir_key):
+            for k in files:
+                yield k
+
+
+class IOScheduler(object):
+    # orders file reads for locality on spinning disks and hints the kernel to read ahead the
+    # exif header of the next files while the current one is processed
+
+    ORDERS = ['inode', 'path', 'none']
+    HEADER_SIZE = 128 * 1024
+    READ_AHEAD = 8
+
+    def __init__(self, order='none', read_ahead=READ_AHEAD):
+        self.order = order
+        self.read_ahead = read_ahead
+        self.can_advise = hasattr(os, 'posix_fadvise') and order != 'none'
+
+    def sort(self, files):
+        if self.order == 'path':
+            return sorted(files)
+        if self.order == 'inode':
+            log.info('Ordering %i files on disk location' % len(files))
+            keys = {}
+            for f in files:
+                try:
+                    st = os.stat(f)
+                    keys[f] = (0, st.st_dev, st.st_ino)
+                except OSError:
+                    keys[f] = (1, 0, 0)
+            return sorted(files, key=lambda i: keys[i])
+        return list(files)
+
+    def advise(self, fd, advice):
+        try:
+            os.posix_fadvise(fd, 0, self.HEADER_SIZE, advice)
+        except OSError as e:
+            log.debug('fadvise failed: %s' % e)
+
+    def prefetch(self, filename):
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            return None
+        self.advise(fd, os.POSIX_FADV_WILLNEED)
+        return fd
+
+    def release(self, fd):
+        if fd is not None:
+            self.advise(fd, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+    def schedule(self, files):
+        files = self.sort(files)
+        if not self.can_advise:
+            for f in files:
+                yield f
+            return
+
+        fds = {}
+        try:
+            for i, f in enumerate(files):
+                for ahead in files[i:i + self.read_ahead + 1]:
+                    if ahead not in fds.keys():
+                        fds[ahead] = self.prefetch(ahead)
+                yield f
+                self.release(fds.pop(f, None))
+        finally:
+            for fd in fds.values():
+                self.release(fd)
+
+
+class HeaderReader(object):
+    # reads file headers ahead on a thread pool driven by an asyncio loop in a background thread,
+    # so on high latency mounts many reads are waiting at the same time, results are handed back in order
+
+    HEADER_SIZE = 64 * 1024
+    DONE = object()
+
+    @classmethod
+    def header_end(cls, data):
+        # number of bytes needed to parse the APP1 segment, None when the whole file is needed
+        if data[:2] != b'\xff\xd8':
+            return None
+        cursor = 2
+        while cursor + 4 <= len(data):
+            if data[cursor] != 0xff:
+                return None
+            marker = data[cursor + 1]
+            if marker == 0xff:
+                cursor = cursor + 1
+                continue
+            if marker == 0xda:
+                # start of the image data, there is no exif
+                return cursor
+            end = cursor + 2 + int.from_bytes(data[cursor + 2:cursor + 4], 'big')
+            if marker == 0xe1:
+                # exif also checks the prefix of the segment after APP1
+                return end + 1
+            cursor = end
+        # the next segment header is not read yet
+        return cursor + 4
+
+    @classmethod
+    def read_header(cls, filename, size=HEADER_SIZE):
+        with open(filename, 'rb') as f:
+            data = f.read(size)
+            while True:
+                end = HeaderReader.header_end(data)
+                if end is None:
+                    data += f.read()
+                    break
+                if end <= len(data):
+                    break
+                more = f.read(max(end - len(data), size))
+                if not more:
+                    break
+                data += more
+            f.close()
+        return data
+
+    def __init__(self, in_flight=0, latency=0.0):
+        self.in_flight = in_flight
+        self.latency = latency
+        self.stopped = False
+        self.error = None
+
+    def read(self, filename):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return HeaderReader.read_header(filename)
+
+    async def hand_over(self, pending, out):
+        item, future = pending
+        try:
+            header = await future
+        except OSError as e:
+            header = e
+        if not self.stopped:
+            await asyncio.get_running_loop().run_in_executor(None, out.put, (item, header))
+
+    async def produce(self, items, filename, out):
+        loop = asyncio.get_running_loop()
+        pending = collections.deque()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.in_flight) as executor:
+                for item in items:
+                    if self.stopped:
+                        break
+                    name = filename(item)
+                    if name is None:
+                        future = loop.create_future()
+                        future.set_result(None)
+                    else:
+                        future = loop.run_in_executor(executor, self.read, name)
+                    pending.append((item, future))
+                    if len(pending) > self.in_flight:
+                        await self.hand_over(pending.popleft(), out)
+                while pending:
+                    await self.hand_over(pending.popleft(), out)
+        except Exception as e:
+            self.error = e
+        finally:
+            out.put(self.DONE)
+
+    def iterate(self, items, filename=lambda i: i):
+        # yields (item, header bytes), header is None for items where filename() gives None
+        if self.in_flight < 1:
+            for item in items:
+                name = filename(item)
+                if name is not None and self.latency > 0:
+                    # only to compare with read ahead, otherwise exif reads the file itself
+                    yield item, self.read(name)
+                else:
+                    yield item, None
+            return
+
+        log.debug('reading ahead %i files' % self.in_flight)
+        out = queue.Queue(maxsize=self.in_flight)
+        self.stopped = False
+        self.error = None
+        thread = threading.Thread(target=asyncio.run, args=(self.produce(items, filename, out),), daemon=True)
+        thread.start()
+        result = None
+        try:
+            while True:
+                result = out.get()
+                if result is self.DONE:
+                    break
+                item, header = result
+                if isinstance(header, Exception):
+                    raise header
+                yield item, header
+        finally:
+            self.stopped = True
+            while result is not self.DONE:
+                result = out.get()
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class DirData(object):
+    @classmethod
+    def create_from_photo_db(cls, photo_db, index=None):
+        if index is None:
+            index = PathIndex.create_from_photo_db(photo_db)
         dir_list = {}
-        progress = PrettyProgress(len(list(photo_db.keys())))
+        dirs = list(index.walk())
+        progress = PrettyProgress(len(dirs))
 
         log.info('looking for good timestamps in all directories')
-        log.info('Indexing %i files' % len(list(photo_db.keys())))
-        for file in photo_db.keys():
+        log.info('Indexing %i directories' % len(dirs))
+        for dir_key, files in dirs:
             progress.step()
-            dir_key = os.path.dirname(file)
-            if dir_key not in dir_list.keys():
+            for file in files:
                 try:
                     if photo_db[file]['has_exif'] and photo_db[file]['ok']:
                         timestamp = photo_db[file]['exif']['datetime']
                         log.debug('found dir %s with date %s' % (dir_key, timestamp))
                         dir_list[dir_key] = timestamp
+                        break
                 except KeyError:
                     continue
         progress.finish()
 
-        log.info('Processed %i files' % progress.progress_count())
+        log.info('Processed %i directories' % progress.progress_count())
         log.info('Stored %i directories in the database' % len(list(dir_list.keys())))
         return DirData(dir_list)
 
@@ -140,13 +464,155 @@ class DirData(object):
             return None
 
 
+class DateMatcher(object):
+
+    FIELDS = ['year', 'month', 'day', 'hour', 'minute', 'second']
+    DEFAULT_TIME = (12, 0, 0)
+
+    @classmethod
+    def load_patterns(cls, filename):
+        log.info('loading filename date patterns from %s' % filename)
+        with open(filename, 'r') as f:
+            patterns = json.load(f)
+            f.close()
+        if not isinstance(patterns, list):
+            raise ValueError('pattern file %s should contain a list of regexes' % filename)
+        return patterns
+
+    @classmethod
+    def create(cls, regex=None, pattern_file=None, match_dir=False):
+        patterns = []
+        if regex is not None:
+            patterns.append(regex)
+        if pattern_file is not None:
+            patterns += DateMatcher.load_patterns(pattern_file)
+        return DateMatcher(patterns + FILENAME_DATE_PATTERNS, match_dir=match_dir)
+
+    def __init__(self, patterns, match_dir=False):
+        # all patterns are combined in one alternation so most names, that have no date, are searched only once.
+        # the leftmost hit of the alternation is not always the best one, so names with a hit are searched again
+        # pattern by pattern in order
+        self.match_dir = match_dir
+        self.patterns = []
+        combined = []
+        for i, pattern in enumerate(patterns):
+            r = re.compile(pattern)
+            if r.groupindex:
+                fields = [r.groupindex.get(f) for f in self.FIELDS]
+            else:
+                fields = list(range(1, r.groups + 1))
+            if None in fields[:3] or len(fields) < 3:
+                raise ValueError('pattern %s needs year, month and day groups' % pattern)
+            self.patterns.append((r, fields[:6]))
+            # group names have to be unique in the combined regex
+            pattern = re.sub(r'\(\?P<(\w+)>', r'(?P<p%i_\1>' % i, pattern)
+            pattern = re.sub(r'\(\?P=(\w+)\)', r'(?P=p%i_\1)' % i, pattern)
+            combined.append('(?:%s)' % pattern)
+        self.regex = re.compile('|'.join(combined))
+        self.dir_cache = {}
+
+    def match(self, name):
+        if self.regex.search(name) is None:
+            return None
+        for r, fields in self.patterns:
+            for m in r.finditer(name):
+                values = [m.group(g) if g is not None else None for g in fields]
+                values += [None] * (6 - len(values))
+                if values[3] is None:
+                    values[3:] = self.DEFAULT_TIME
+                # an hour without minutes or seconds is on the full hour
+                values[4:] = [v if v is not None else 0 for v in values[4:]]
+                try:
+                    date = datetime.datetime(*[int(v) for v in values])
+                except ValueError:
+                    log.debug('match %s in %s is not a valid datetime' % (m.group(0), name))
+                    continue
+                return date.strftime(EXIF_DATETIME_FORMAT)
+        return None
+
+    def match_parent_dirs(self, dir_key):
+        if dir_key in self.dir_cache.keys():
+            return self.dir_cache[dir_key]
+        date = None
+        if dir_key != '':
+            date = self.match(os.path.basename(dir_key))
+            if date is None:
+                date = self.match_parent_dirs(os.path.dirname(dir_key))
+        self.dir_cache[dir_key] = date
+        return date
+
+    def get(self, filename):
+        date = self.match(os.path.basename(filename))
+        if date is not None:
+            return date, 'DATETIME FOUND IN FILENAME'
+        if self.match_dir:
+            date = self.match_parent_dirs(os.path.dirname(filename))
+            if date is not None:
+                return date, 'DATETIME FOUND IN DIRECTORY NAME'
+        return None, None
+
+
+class DBFile(object):
+    # the db is a json object, entries are written sorted on key with one entry per line
+    # so it can also be read and written as a stream without holding it in memory
+
+    @classmethod
+    def header(cls, path):
+        return {'format': DB_FORMAT, 'version': DB_SCHEMA_VERSION, 'base_path': path}
+
+    @classmethod
+    def write(cls, db_file, path, entries):
+        tmp_file = '%s.tmp' % db_file
+        count = 0
+        with open(tmp_file, 'w') as f:
+            f.write('%s, "files": {\n' % json.dumps(DBFile.header(path))[:-1])
+            for k, entry in entries:
+                if count > 0:
+                    f.write(',\n')
+                f.write('%s: %s' % (json.dumps(k), json.dumps(entry)))
+                count = count + 1
+            f.write('\n}}\n')
+            f.close()
+        os.replace(tmp_file, db_file)
+        return count
+
+    @classmethod
+    def is_streamable(cls, db_file):
+        with open(db_file, 'r') as f:
+            first = f.readline()
+            f.close()
+        try:
+            header = json.loads('%s}}' % first.rstrip('\n'))
+        except ValueError:
+            return False
+        return header.get('format') == DB_FORMAT and header.get('version') == DB_SCHEMA_VERSION
+
+    @classmethod
+    def iter_entries(cls, db_file):
+        with open(db_file, 'r') as f:
+            f.readline()
+            for line in f:
+                line = line.rstrip('\n')
+                if line == '}}':
+                    break
+                entry = json.loads('{%s}' % line.rstrip(','))
+                for k in entry.keys():
+                    yield k, entry[k]
+            f.close()
+
+
 class PhotoData(object):
 
     CSV_FIELDNAMES = ['filename', 'has_exif', 'datetime', 'datetime_original',
                       'datetime_digitized', 'ok', 'issue', 'can_fix']
+    MAP_ISSUES = ['NO METADATA', 'NO DATETIME IN EXIF', 'ERROR READING EXIF', 'INVALID DATETIME ENTRY']
 
     @classmethod
-    def get_exif_from_file(cls, filename):
+    def get_exif_from_file(cls, filename, header=None):
+        if header is not None:
+            img = exif.Image(header)
+            log.debug('has exif: %s' % img.has_exif)
+            return img
         with open(filename, 'rb') as image_file:
             try:
                 img = exif.Image(image_file)
@@ -158,15 +624,19 @@ class PhotoData(object):
         return img
 
     @classmethod
-    def process_file(cls, file_name, base_path=''):
+    def is_picture(cls, file_name):
+        return os.path.basename(file_name).split('.').pop().lower() in IMAGE_EXTENSIONS
+
+    @classmethod
+    def process_file(cls, file_name, base_path='', header=None):
         log.debug('Processing file %s' % file_name)
         r = re.compile('^%s' % os.path.join(base_path, ''))
         file_name = r.sub('', file_name)
 
-        if os.path.basename(file_name).split('.').pop().lower() not in IMAGE_EXTENSIONS:
+        if not PhotoData.is_picture(file_name):
             return {'filename': file_name, 'ok': False, 'issue': 'NO PICTURE FILE'}
         try:
-            img = PhotoData.get_exif_from_file(os.path.join(base_path, file_name))
+            img = PhotoData.get_exif_from_file(os.path.join(base_path, file_name), header=header)
         except plum.UnpackError:
             return {'filename': file_name, 'ok': False, 'issue': 'ERROR READING EXIF'}
         except ValueError:
@@ -180,40 +650,197 @@ class PhotoData(object):
 
         if img.has_exif:
             try:
-                data['exif']['datetime'] = img.datetime
-                try:
-                    date_check = datetime.datetime.strptime(data['exif']['datetime'], EXIF_DATETIME_FORMAT)
-                    log.debug('Checking date %s' % date_check)
-                    if date_check.year == 0:
-                        raise ValueError()
-                except ValueError:
-                    data['exif'] = {}
-                    data['issue'] = 'INVALID DATETIME ENTRY'
-                    return data
-                data['ok'] = True
+                date = img.datetime
             except AttributeError:
                 data['issue'] = 'NO DATETIME IN EXIF'
                 return data
+            if PhotoData.timestamp(date) is None:
+                data['issue'] = 'INVALID DATETIME ENTRY'
+                return data
             try:
-                data['exif']['datetime_original'] = img.datetime_original
+                date_original = img.datetime_original
             except AttributeError:
-                data['exif']['datetime_original'] = img.datetime
+                date_original = date
             try:
-                data['exif']['datetime_digitized'] = img.datetime_digitized
+                date_digitized = img.datetime_digitized
             except AttributeError:
-                data['exif']['datetime_digitized'] = img.datetime
+                date_digitized = date
+            PhotoData.set_exif(data, date, date_original, date_digitized)
+            data['ok'] = True
         else:
             data['issue'] = 'NO METADATA'
         return data
 
     @classmethod
-    def scan(cls, path, db_file='db.json', rebuild=False):
+    def timestamp(cls, date):
+        # seconds since 1970 for a valid exif date, None when it is not valid
+        try:
+            return int((datetime.datetime.strptime(date, EXIF_DATETIME_FORMAT) - EPOCH).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def set_exif(cls, entry, date, date_original=None, date_digitized=None):
+        # dates are only validated here, checks later on use the stored timestamps
+        if date_original is None:
+            date_original = date
+        if date_digitized is None:
+            date_digitized = date
+        entry['exif'] = {'datetime': date, 'datetime_original': date_original, 'datetime_digitized': date_digitized}
+        checked = {}
+        entry['timestamps'] = {}
+        for k in entry['exif'].keys():
+            if entry['exif'][k] not in checked.keys():
+                checked[entry['exif'][k]] = PhotoData.timestamp(entry['exif'][k])
+            entry['timestamps'][k] = checked[entry['exif'][k]]
+
+    @classmethod
+    def timestamps(cls, entry):
+        if 'exif' not in entry.keys():
+            return {}
+        if 'timestamps' not in entry.keys():
+            entry['timestamps'] = {}
+            for k in entry.get('exif', {}).keys():
+                entry['timestamps'][k] = PhotoData.timestamp(entry['exif'][k])
+        return entry['timestamps']
+
+    @classmethod
+    def in_shard(cls, relative_filename, shard=None):
+        if shard is None:
+            return True
+        index, count = shard
+        return zlib.crc32(relative_filename.encode('utf-8')) % count == index - 1
+
+    @classmethod
+    def needs_read(cls, entry):
+        if entry is None:
+            return True
+        if not entry['ok']:
+            return entry['issue'] != 'NO PICTURE FILE'
+        return PhotoData.timestamps(entry).get('datetime') is None
+
+    @classmethod
+    def scan_roots(cls, subdirs=None):
+        # relative directories to walk in key order, roots sort as 'name/' too
+        # and roots inside an other root are dropped as they would be walked twice
+        if not subdirs:
+            return ['']
+        roots = []
+        for d in sorted((os.path.join(PathIndex.normalize(d), '') for d in subdirs)):
+            if not any(d.startswith(root) for root in roots):
+                roots.append(d)
+        return [d.rstrip(os.sep) for d in roots]
+
+    @classmethod
+    def walk_sorted(cls, path, subdirs=None):
+        # yields relative filenames in the same order as sorting the keys, one directory listed at a time,
+        # a directory sorts as 'name/' against the files next to it
+        for root in PhotoData.scan_roots(subdirs):
+            stack = [(root, True)]
+            while stack:
+                name, is_dir = stack.pop()
+                if not is_dir:
+                    yield name
+                    continue
+                log.debug('Listing files in %s' % os.path.join(path, name))
+                children = []
+                with os.scandir(os.path.join(path, name)) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                children.append((os.path.join(name, entry.name, ''), True))
+                        else:
+                            children.append((os.path.join(name, entry.name), False))
+                for child, child_is_dir in sorted(children, reverse=True):
+                    stack.append((child.rstrip(os.sep) if child_is_dir else child, child_is_dir))
+
+    @classmethod
+    def scan_bounded(cls, path, db_file='db.json', rebuild=False, shard=None, subdirs=None, reader=None):
+        clean_exit = CleanExit()
+        old_entries = iter([])
+        if os.path.isfile(db_file):
+            if not rebuild:
+                log.info('Updating current Picture db %s' % db_file)
+                if not DBFile.is_streamable(db_file):
+                    log.warning('Upgrading %s before streaming it, this loads it in memory once' % db_file)
+                    PhotoData.load(path, db_file)
+                old_entries = DBFile.iter_entries(db_file)
+            else:
+                log.warning('Overwriting current Picture db %s' % db_file)
+        if shard is not None:
+            log.info('Scanning shard %i/%i' % shard)
+
+        counts = {'files': 0, 'read': 0, 'removed': 0}
+        if reader is None:
+            reader = HeaderReader()
+
+        def candidates():
+            # sorted merge of the file system walk with the sorted entries of the old db
+            old = next(old_entries, None)
+            for k in PhotoData.walk_sorted(path, subdirs):
+                if clean_exit.exit:
+                    return
+                if not PhotoData.in_shard(k, shard):
+                    continue
+                while old is not None and old[0] < k:
+                    log.debug('removing %s out of db' % old[0])
+                    counts['removed'] = counts['removed'] + 1
+                    old = next(old_entries, None)
+                entry = None
+                if old is not None and old[0] == k:
+                    entry = old[1]
+                    old = next(old_entries, None)
+                yield k, entry, PhotoData.needs_read(entry)
+            while old is not None:
+                log.debug('removing %s out of db' % old[0])
+                counts['removed'] = counts['removed'] + 1
+                old = next(old_entries, None)
+
+        def to_read(candidate):
+            k, entry, needs_read = candidate
+            if needs_read and PhotoData.is_picture(k):
+                return os.path.join(path, k)
+            return None
+
+        def entries():
+            for (k, entry, needs_read), header in reader.iterate(candidates(), to_read):
+                if clean_exit.exit:
+                    return
+                if needs_read:
+                    entry = PhotoData.process_file(os.path.join(path, k), base_path=path, header=header)
+                    counts['read'] = counts['read'] + 1
+                else:
+                    log.debug('%s already in db' % k)
+                counts['files'] = counts['files'] + 1
+                yield k, entry
+
+        log.info('Indexing files in %s directory by directory' % path)
+        count = DBFile.write('%s.scan' % db_file, path, entries())
+        if clean_exit.exit:
+            log.warning('Not saving as CTRL+C was pressed during processing')
+            os.remove('%s.scan' % db_file)
+            return
+        os.replace('%s.scan' % db_file, db_file)
+        log.info('Processed %i files' % counts['files'])
+        log.info('Needed to read EXIF data for %i files' % counts['read'])
+        log.info('removed %i items out of db that are not on filesystem' % counts['removed'])
+        log.info('saved %i db entries to %s' % (count, db_file))
+
+    @classmethod
+    def scan(cls, path, db_file='db.json', rebuild=False, shard=None, subdirs=None, io_order='none', reader=None):
         clean_exit = CleanExit()
         file_list = []
-        log.info('Listing all files in %s' % path)
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                file_list.append(os.path.join(root, file))
+        r = re.compile('^%s' % os.path.join(path, ''))
+        scan_roots = [os.path.join(path, d) if d != '' else path for d in PhotoData.scan_roots(subdirs)]
+        if shard is not None:
+            log.info('Scanning shard %i/%i' % shard)
+        for scan_root in scan_roots:
+            log.info('Listing all files in %s' % scan_root)
+            for root, dirs, files in os.walk(scan_root):
+                for file in files:
+                    f = os.path.join(root, file)
+                    if PhotoData.in_shard(r.sub('', f), shard):
+                        file_list.append(f)
 
         db = {}
         if os.path.isfile(db_file):
@@ -224,39 +851,32 @@ class PhotoData(object):
                 log.warning('Overwriting current Picture db %s' % db_file)
 
         log.info('Indexing %i files in %s' % (len(file_list), path))
-        progress = PrettyProgress(len(file_list))
-        r = re.compile('^%s' % os.path.join(path, ''))
-        read_count = 0
+        pending = []
         for f in file_list:
-            progress.step()
-            relative_filename = r.sub('', f)
-            if relative_filename not in db.keys():
-                data = PhotoData.process_file(f, base_path=path)
-                db[relative_filename] = data
-                read_count = read_count + 1
-            elif not db[relative_filename]['ok']:
-                if db[relative_filename]['issue'] == 'NO PICTURE FILE':
-                    continue
-                data = PhotoData.process_file(f, base_path=path)
-                db[relative_filename] = data
-                read_count = read_count + 1
+            if PhotoData.needs_read(db.get(r.sub('', f))):
+                pending.append(f)
             else:
-                try:
-                    date_check = datetime.datetime.strptime(db[relative_filename]['exif']['datetime'],
-                                                            EXIF_DATETIME_FORMAT)
-                    if date_check.year == 0:
-                        raise ValueError()
-                    else:
-                        log.debug('%s already in db' % relative_filename)
-                except ValueError:
-                    data = PhotoData.process_file(f, base_path=path)
-                    db[relative_filename] = data
-                    read_count = read_count + 1
+                log.debug('%s already in db' % f)
+        log.info('Need to read EXIF data for %i files' % len(pending))
+
+        if reader is None:
+            reader = HeaderReader()
+        progress = PrettyProgress(len(pending))
+        read_count = 0
+        if reader.in_flight > 0:
+            # the reader already reads ahead, the fadvise window would drop the pages of reads still in flight
+            files = IOScheduler(io_order).sort(pending)
+        else:
+            files = IOScheduler(io_order).schedule(pending)
+        for f, header in reader.iterate(files, lambda i: i if PhotoData.is_picture(i) else None):
             if clean_exit.exit:
                 break
+            progress.step()
+            db[r.sub('', f)] = PhotoData.process_file(f, base_path=path, header=header)
+            read_count = read_count + 1
         progress.finish()
         log.info('Processed %i files' % progress.progress_count())
-        log.info('Needed to read EXIF data for %i files' % read_count)
+        log.info('Read EXIF data for %i files' % read_count)
 
         log.info('Look for removed files in %i db entries' % len(list(db.keys())))
         rm_count = 0
@@ -272,29 +892,85 @@ class PhotoData(object):
         return PhotoData(path, db, db_file=db_file)
 
     @classmethod
-    def load(cls, path, db_file):
+    def merge_entry(cls, current, new):
+        # deterministic regardless of the order of the partial databases:
+        # ok entries win, then entries with a timestamp, then entries with that timestamp written to the file,
+        # then the last written file, then the smallest serialized entry
+        def rank(entry):
+            has_date = 'exif' in entry.keys() and entry['exif'].get('datetime') is not None
+            written = entry.get('written', {})
+            is_written = has_date and written.get('datetime') == entry['exif']['datetime']
+            return (not entry['ok'], not has_date, not is_written, -written.get('mtime_ns', 0),
+                    json.dumps(entry, sort_keys=True))
+
+        if rank(new) < rank(current):
+            return new
+        return current
+
+    @classmethod
+    def merge(cls, path, partials, db_file='db.json'):
+        # streaming k-way merge of the sorted partial databases, the partial files are not changed
+        clean_exit = CleanExit()
+        tmp_files = []
+        streams = []
+        counts = {'entries': 0, 'conflicts': 0}
         try:
-            log.debug('loading photo db from %s' % db_file)
-            with open(db_file, 'r') as f:
-                db = json.load(f)
-                f.close()
-        except Exception as e:
-            raise e
+            for i, partial in enumerate(partials):
+                if not DBFile.is_streamable(partial):
+                    tmp_file = '%s.merge%i' % (db_file, i)
+                    log.warning('Upgrading a copy of %s, this loads it in memory once' % partial)
+                    db = PhotoData.read(path, partial)
+                    DBFile.write(tmp_file, path, ((k, db[k]) for k in sorted(db.keys())))
+                    db = None
+                    tmp_files.append(tmp_file)
+                    partial = tmp_file
+                log.info('Merging partial db %s' % partial)
+                streams.append(DBFile.iter_entries(partial))
+
+            def entries():
+                current = None
+                for k, entry in heapq.merge(*streams, key=lambda i: i[0]):
+                    if clean_exit.exit:
+                        return
+                    counts['entries'] = counts['entries'] + 1
+                    if current is not None and current[0] == k:
+                        log.debug('conflict for %s' % k)
+                        counts['conflicts'] = counts['conflicts'] + 1
+                        current = (k, PhotoData.merge_entry(current[1], entry))
+                        continue
+                    if current is not None:
+                        yield current
+                    current = (k, entry)
+                if current is not None:
+                    yield current
 
-        need_save = False
-        if isinstance(db, list):
-            log.debug('db file is flat file list ... converting ... ')
-            new_db = {}
-            for f in db:
-                new_db[f['filename']] = f
-            db = new_db
-            need_save = True
+            count = DBFile.write('%s.merge' % db_file, path, entries())
+            if clean_exit.exit:
+                log.warning('Not saving as CTRL+C was pressed during processing')
+                os.remove('%s.merge' % db_file)
+                return
+            os.replace('%s.merge' % db_file, db_file)
+        finally:
+            for tmp_file in tmp_files:
+                os.remove(tmp_file)
+        log.info('Processed %i entries' % counts['entries'])
+        log.info('Resolved %i conflicting entries' % counts['conflicts'])
+        log.info('saved %i db entries to %s' % (count, db_file))
 
+    @classmethod
+    def migrate_list(cls, db, path):
+        log.debug('db file is flat file list ... converting ... ')
+        new_db = {}
+        for f in db:
+            new_db[f['filename']] = f
+        return new_db
+
+    @classmethod
+    def migrate_relative_paths(cls, db, path):
         r = re.compile('^%s' % os.path.join(path, ''))
         for f in list(db.keys()):
             if r.match(db[f]['filename']):
                 db[f]['filename'] = r.sub('', db[f]['filename'])
-                need_save = True
                 log.debug('found absolute path in %s filename' % db[f]['filename'])
             if r.match(f):
                 log.debug('found absolute path in %s' % f)
@@ -303,14 +979,84 @@ class PhotoData(object):
                 i = db.pop(f)
                 i['filename'] = r.sub('', i['filename'])
                 db[k] = i
-                need_save = True
+        return db
+
+    @classmethod
+    def migrate_line_layout(cls, db, path):
+        # nothing to change in the entries, saving writes them sorted one per line
+        return db
+
+    @classmethod
+    def migrate_timestamps(cls, db, path):
+        for k in db.keys():
+            db[k].pop('timestamps', None)
+            PhotoData.timestamps(db[k])
+        return db
+
+    # migration to run on a db of schema version <key> to get to the next version
+    MIGRATIONS = {
+        0: 'migrate_list',
+        1: 'migrate_relative_paths',
+        2: 'migrate_line_layout',
+        3: 'migrate_timestamps',
+    }
 
-        fd = PhotoData(path, db, db_file=db_file)
-        if need_save:
-            log.debug('Saving updated db on load')
+    @classmethod
+    def read_header(cls, data):
+        if isinstance(data, list):
+            return 0, data
+        if not isinstance(data, dict):
+            raise ValueError('unknown db layout')
+        if isinstance(data.get('format'), str):
+            if data['format'] != DB_FORMAT:
+                raise ValueError('unknown db format %s' % data['format'])
+            return data['version'], data['files']
+        return 1, data
+
+    @classmethod
+    def read(cls, path, db_file):
+        # the db of a file upgraded to the current schema version, the file itself is not changed
+        version, db = PhotoData.read_version(db_file)
+        return PhotoData.upgrade(db, version, path)
+
+    @classmethod
+    def read_version(cls, db_file):
+        try:
+            log.debug('loading photo db from %s' % db_file)
+            with open(db_file, 'r') as f:
+                data = json.load(f)
+                f.close()
+        except Exception as e:
+            raise e
+
+        try:
+            version, db = PhotoData.read_header(data)
+        except (KeyError, ValueError) as e:
+            log.error('%s is not a picture database: %s' % (db_file, e))
+            sys.exit(1)
+        if version > DB_SCHEMA_VERSION:
+            log.error('%s has schema version %i, this version only supports up to %i'
+                      % (db_file, version, DB_SCHEMA_VERSION))
+            sys.exit(1)
+        return version, db
+
+    @classmethod
+    def load(cls, path, db_file):
+        version, db = PhotoData.read_version(db_file)
+        fd = PhotoData(path, PhotoData.upgrade(db, version, path), db_file=db_file)
+        if version < DB_SCHEMA_VERSION:
+            log.info('Saving db upgraded from schema version %i to %i' % (version, DB_SCHEMA_VERSION))
             fd.save()
         return fd
 
+    @classmethod
+    def upgrade(cls, db, version, path):
+        while version < DB_SCHEMA_VERSION:
+            log.info('Upgrading db from schema version %i' % version)
+            db = getattr(PhotoData, PhotoData.MIGRATIONS[version])(db, path)
+            version = version + 1
+        return db
+
     def __init__(self, path, db, db_file='db.json'):
         self.path = path
         self.db = db
@@ -318,45 +1064,66 @@ class PhotoData(object):
         self.can_save = True
         self.clean_exit = CleanExit()
         self.progress = PrettyProgress(len(list(self.db.keys())))
+        self.path_index = None
+        self.background_save = False
+        self.dirty = False
+
+    def index(self):
+        if self.path_index is None:
+            log.debug('building path index for %i entries' % len(self))
+            self.path_index = PathIndex.create_from_photo_db(self.db)
+        return self.path_index
+
+    def subtree(self, dir_key):
+        log.info('Selecting entries under %s' % dir_key)
+        db = {}
+        for k in self.index().subtree(dir_key):
+            db[k] = self.db[k]
+        log.info('found %i entries under %s' % (len(list(db.keys())), dir_key))
+        return PhotoData(self.path, db, db_file='')
 
     def save(self):
+        if self.background_save:
+            log.debug('db changed, saving in background')
+            self.dirty = True
+        else:
+            self.write()
+
+    def write(self):
         if self.can_save:
             log.info('saving %i db entries to %s' % (len(self), self.db_file))
-            with open(self.db_file, 'w') as f:
-                json.dump(self.db, f, indent=4)
-                f.close()
+            DBFile.write(self.db_file, self.path, ((k, self.db[k]) for k in sorted(self.db.keys())))
         else:
             log.warning('Not saving as CTRL+C was pressed during processing')
 
-    def remove(self, filename=None, regex=None):
-        r = None
-        if regex is not None:
+    def remove(self, filename=None, regex=None, dir_key=None):
+        if filename is not None:
+            log.debug('looking up basename %s' % filename)
+            candidates = self.index().by_basename(filename)
+        elif dir_key is not None:
+            log.debug('looking up entries under %s' % dir_key)
+            candidates = list(self.index().subtree(dir_key))
+        else:
             log.debug('creating regex for %s' % regex)
             r = re.compile(regex)
+            candidates = [k for k in self.db.keys() if r.match(k)]
 
         file_count = 0
-        log.info('Checking %i db entries for removal' % len(list(self.db.keys())))
-        self.progress.reset()
-        for k in list(self.db.keys()):
+        log.info('Removing %i db entries' % len(candidates))
+        progress = PrettyProgress(len(candidates))
+        for k in candidates:
             if self.clean_exit.exit:
                 self.can_save = False
                 break
 
-            self.progress.step()
-            remove = False
-            if filename is not None:
-                if os.path.basename(k) == filename:
-                    remove = True
-            elif r is not None:
-                if r.match(k):
-                    remove = True
-            if remove:
-                log.debug('removing %s' % k)
-                self.db.pop(k)
-                file_count = file_count + 1
+            progress.step()
+            log.debug('removing %s' % k)
+            self.db.pop(k)
+            self.index().remove(k)
+            file_count = file_count + 1
 
-        self.progress.finish()
-        log.info('Processed %i entries' % self.progress.progress_count())
+        progress.finish()
+        log.info('Processed %i entries' % progress.progress_count())
         log.info('Removed %s files from Picture Database' % file_count)
         if file_count > 0:
             self.save()
@@ -376,52 +1143,130 @@ class PhotoData(object):
         return PhotoData(self.path, db, '%s.problems' % self.db_file)
 
     def dir_date_map(self):
-        date_db = DirData.create_from_photo_db(self.db)
+        date_db = DirData.create_from_photo_db(self.db, index=self.index())
         log.info('Trying to fix %i DB entries with dir map' % len(list(self.db.keys())))
         self.progress.reset()
         fix_count = 0
-        for k in self.db.keys():
+        # nearest directory with a date, filled top-down while walking the index
+        nearest = {}
+        for dir_key, files in self.index().walk():
             if self.clean_exit.exit:
                 break
 
-            self.progress.step()
-            if not self.db[k]['ok'] and self.db[k]['issue'] in ['NO METADATA',
-                                                                'NO DATETIME IN EXIF',
-                                                                'ERROR READING EXIF',
-                                                                'INVALID DATETIME ENTRY']:
-                dir_key = os.path.dirname(k)
-                log.debug('looking for %s in date map' % dir_key)
-                date = date_db.get(dir_key)
-                if date is not None:
-                    log.debug('Updating picture file %s metadata to same as dir data %s' % (k, date))
-                    self.db[k]['exif'] = {'datetime': date, 'datetime_original': date, 'datetime_digitized': date}
-                    self.db[k]['issue'] = 'METADATA MATCHED TO FILES IN SAME DIR'
-                    self.db[k]['has_exif'] = True
-                    fix_count = fix_count + 1
-                else:
-                    log.debug('%s not found in directory map' % dir_key)
-                    dir_key = os.path.dirname(dir_key)
-                    while dir_key != '':
-                        log.debug('trying key %s' % dir_key)
-                        date = date_db.get(dir_key)
-                        if date is not None:
-                            log.debug('Updating picture file %s metadata to same as'
-                                      'higher level dir %s date is %s' % (k, dir_key, date))
-                            self.db[k]['exif'] = {'datetime': date, 'datetime_original': date,
-                                                  'datetime_digitized': date}
-                            self.db[k]['issue'] = 'METADATA MATCHED TO FILE IN HIGHER DIR %s' % dir_key
-                            self.db[k]['has_exif'] = True
-                            fix_count = fix_count + 1
-                            break
-                        dir_key = os.path.dirname(dir_key)
+            parent = None
+            if dir_key != '':
+                parent = nearest[os.path.dirname(dir_key)]
+            date = date_db.get(dir_key)
+            # like before, a date of the library root itself is not used for its subdirectories
+            nearest[dir_key] = (dir_key, date) if date is not None and dir_key != '' else parent
+
+            for k in files:
+                self.progress.step()
+                if not self.db[k]['ok'] and self.db[k]['issue'] in self.MAP_ISSUES:
+                    if date is not None:
+                        log.debug('Updating picture file %s metadata to same as dir data %s' % (k, date))
+                        PhotoData.set_exif(self.db[k], date)
+                        self.db[k]['issue'] = 'METADATA MATCHED TO FILES IN SAME DIR'
+                        self.db[k]['has_exif'] = True
+                        fix_count = fix_count + 1
+                    elif parent is not None:
+                        higher_dir, higher_date = parent
+                        log.debug('Updating picture file %s metadata to same as'
+                                  'higher level dir %s date is %s' % (k, higher_dir, higher_date))
+                        PhotoData.set_exif(self.db[k], higher_date)
+                        self.db[k]['issue'] = 'METADATA MATCHED TO FILE IN HIGHER DIR %s' % higher_dir
+                        self.db[k]['has_exif'] = True
+                        fix_count = fix_count + 1
+                    else:
+                        log.debug('%s not found in directory map' % dir_key)
         self.progress.finish()
         log.info('Processed %i DB entries' % self.progress.progress_count())
         log.info('Was able to fix %i entries in DB' % fix_count)
         if fix_count > 0:
             self.save()
 
-    def fix(self, regex=IMG_FILENAME_REGEX):
-        r = re.compile(regex)
+    @classmethod
+    def anchor_date(cls, entry):
+        # dates that can be interpolated between, not ones copied from other files
+        issue = entry.get('issue')
+        if issue is not None and (issue.startswith('METADATA MATCHED') or issue == 'DATETIME INTERPOLATED'):
+            return None
+        timestamp = PhotoData.timestamps(entry).get('datetime')
+        if timestamp is None:
+            return None
+        return EPOCH + datetime.timedelta(seconds=timestamp)
+
+    def interpolate(self):
+        r = re.compile(SEQUENCE_REGEX, re.IGNORECASE)
+        log.info('Trying to interpolate dates for %i DB entries' % len(list(self.db.keys())))
+        self.progress.reset()
+        fix_count = 0
+        for dir_key, files in self.index().walk():
+            if self.clean_exit.exit:
+                self.can_save = False
+                break
+
+            files = [k for k in files if self.db[k].get('issue') != 'NO PICTURE FILE']
+            numbers = {}
+            for k in files:
+                m = r.search(os.path.splitext(os.path.basename(k))[0])
+                if m is None:
+                    break
+                numbers[k] = int(m.group(1))
+            # order on camera sequence number if all files have one, otherwise on name
+            if len(numbers) == len(files):
+                order = sorted(files, key=lambda i: (numbers[i], i))
+                positions = [numbers[k] for k in order]
+            else:
+                order = sorted(files)
+                positions = list(range(len(order)))
+
+            anchor_positions = []
+            anchor_dates = []
+            for position, k in zip(positions, order):
+                date = PhotoData.anchor_date(self.db[k])
+                if date is not None:
+                    anchor_positions.append(position)
+                    anchor_dates.append(date)
+            if not anchor_positions:
+                log.debug('no dates to interpolate from in %s' % dir_key)
+                for _ in files:
+                    self.progress.step()
+                continue
+
+            for position, k in zip(positions, order):
+                self.progress.step()
+                if self.db[k]['ok'] or self.db[k]['issue'] not in self.MAP_ISSUES:
+                    continue
+                i = bisect.bisect_left(anchor_positions, position)
+                try:
+                    if i == len(anchor_positions):
+                        # after the last date, keep the order with one second per step
+                        date = anchor_dates[-1] + datetime.timedelta(seconds=position - anchor_positions[-1])
+                    elif anchor_positions[i] == position or i == 0:
+                        date = anchor_dates[i] - datetime.timedelta(seconds=anchor_positions[i] - position)
+                    else:
+                        span = anchor_positions[i] - anchor_positions[i - 1]
+                        date = anchor_dates[i - 1] + (anchor_dates[i] - anchor_dates[i - 1]) * (
+                            (position - anchor_positions[i - 1]) / span)
+                except OverflowError:
+                    log.debug('Interpolated date for %s is out of range' % k)
+                    continue
+                date = date.replace(microsecond=0).strftime(EXIF_DATETIME_FORMAT)
+                log.debug('Interpolated date %s for %s' % (date, k))
+                PhotoData.set_exif(self.db[k], date)
+                self.db[k]['issue'] = 'DATETIME INTERPOLATED'
+                self.db[k]['has_exif'] = True
+                fix_count = fix_count + 1
+        self.progress.finish()
+        log.info('Processed %i DB entries' % self.progress.progress_count())
+        log.info('Was able to interpolate %i entries in DB' % fix_count)
+        if fix_count > 0:
+            self.save()
+
+    def fix(self, matcher=None):
+        if matcher is None:
+            matcher = DateMatcher.create()
         log.info('Trying to fix %i DB entries' % len(list(self.db.keys())))
         fix_count = 0
         self.progress.reset()
@@ -442,50 +1287,30 @@ class PhotoData(object):
                         try:
                             date = img.datetime_digitized
                         except AttributeError:
-                            log.debug('regex matching for date in file name %s' % k)
-                            if r.match(os.path.basename(k)):
-                                log.debug('regex matched')
-                                groups = r.match(os.path.basename(k)).groups()
-                                date = '%s:%s:%s 12:00:00' % (groups[0], groups[1], groups[2])
-                                try:
-                                    datetime.datetime.strptime(date, EXIF_DATETIME_FORMAT)
-                                except ValueError:
-                                    log.error('regex match dit not have valid datetime for %s' % date)
-                                    continue
-                                log.debug('date out of regex is %s' % date)
-                                issue = 'DATETIME FOUND IN FILENAME'
-                            else:
+                            log.debug('matching for date in file name %s' % k)
+                            date, issue = matcher.get(k)
+                            if date is None:
                                 continue
+                            log.debug('date out of file name is %s' % date)
                     log.debug('updating %s datetime to %s' % (k, date))
-                    self.db[k]['exif'] = {'datetime': date, 'datetime_original': date, 'datetime_digitized': date}
+                    PhotoData.set_exif(self.db[k], date)
                     self.db[k]['issue'] = issue
                     fix_count = fix_count + 1
                 elif self.db[k]['issue'] == 'NO METADATA':
-                    log.debug('no metadata, matching file %s for regex' % k)
-                    if r.match(os.path.basename(k)):
-                        log.debug('regex matched')
-                        groups = r.match(os.path.basename(k)).groups()
-                        date = '%s:%s:%s 12:00:00' % (groups[0], groups[1], groups[2])
-                        try:
-                            datetime.datetime.strptime(date, EXIF_DATETIME_FORMAT)
-                            log.debug('date out of regex is %s' % date)
-                            issue = 'DATETIME FOUND IN FILENAME'
-                            self.db[k]['exif'] = {'datetime': date, 'datetime_original': date,
-                                                  'datetime_digitized': date}
-                            self.db[k]['issue'] = issue
-                            fix_count = fix_count + 1
-                        except ValueError:
-                            log.error('regex match dit not have valid datetime for %s' % date)
-                            continue
+                    log.debug('no metadata, matching file name %s for a date' % k)
+                    date, issue = matcher.get(k)
+                    if date is not None:
+                        log.debug('date out of file name is %s' % date)
+                        PhotoData.set_exif(self.db[k], date)
+                        self.db[k]['issue'] = issue
+                        fix_count = fix_count + 1
             else:
+                timestamps = PhotoData.timestamps(self.db[k])
                 for entry in ['datetime_original', 'datetime_digitized']:
-                    try:
-                        date_check = datetime.datetime.strptime(self.db[k]['exif'][entry], EXIF_DATETIME_FORMAT)
-                        if date_check.year == 0:
-                            raise ValueError()
-                    except ValueError:
+                    if timestamps.get(entry) is None:
                         log.debug('%s has invalid datetime, copying from datetime entry' % entry)
                         self.db[k]['exif'][entry] = self.db[k]['exif']['datetime']
+                        timestamps[entry] = timestamps['datetime']
                         fix_count = fix_count + 1
 
         self.progress.finish()
@@ -620,9 +1445,7 @@ class PhotoData(object):
                                         date_digitized = date
                                     log.debug('updating %s to datetime %s' % (f, date))
                                     try:
-                                        self.db[f]['exif']['datetime'] = date
-                                        self.db[f]['exif']['datetime_original'] = date_original
-                                        self.db[f]['exif']['datetime_digitized'] = date_digitized
+                                        PhotoData.set_exif(self.db[f], date, date_original, date_digitized)
                                         self.db[f]['issue'] = 'MANUAL FIX'
                                         self.db[f]['has_exif'] = True
                                         log.debug('update ok')
@@ -654,13 +1477,17 @@ class PhotoData(object):
         r = re.compile('^%s' % os.path.join(self.path, ''))
         if r.match(filename):
             filename = r.sub('', filename)
-        if filename in self.db.keys():
-            if not force:
-                log.warning('%s already in DB use --force to overwrite' % filename)
-            else:
-                data = PhotoData.process_file(os.path.join(self.path, filename), base_path=self.path)
-                log.info('adding %s to DB' % filename)
-                self.db[filename] = data
+        # a failed add raises so the daemon can answer it as an error
+        if filename in self.db.keys() and not force:
+            raise ValueError('%s already in DB use --force to overwrite' % filename)
+        if not os.path.isfile(os.path.join(self.path, filename)):
+            raise ValueError('%s not found in %s' % (filename, self.path))
+        data = PhotoData.process_file(os.path.join(self.path, filename), base_path=self.path)
+        log.info('adding %s to DB' % filename)
+        if filename not in self.db.keys() and self.path_index is not None:
+            self.path_index.add(filename)
+        self.db[filename] = data
+        self.save()
 
     def __str__(self):
         out = '%-40s%-6s%-20s%-6s%-30s\n' % ('FILENAME', 'EXIF', 'DATETIME', 'OK', 'ISSUE')
@@ -716,33 +1543,67 @@ class PhotoData(object):
 
 
 class PictureUpdater(object):
-    def __init__(self, db, path='.'):
+    def __init__(self, db, path='.', io_order='none'):
         self.db = db
         self.dir = path
+        self.scheduler = IOScheduler(io_order)
         self.EXIT = CleanExit()
 
+    @classmethod
+    def fingerprint(cls, filename):
+        st = os.stat(filename)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    @classmethod
+    def is_written(cls, entry, filename):
+        # done when the timestamp we want was written and the file did not change since
+        try:
+            written = entry['written']
+            if written['datetime'] != entry['exif']['datetime']:
+                return False
+            fingerprint = PictureUpdater.fingerprint(filename)
+        except (KeyError, OSError):
+            return False
+        return fingerprint['size'] == written['size'] and fingerprint['mtime_ns'] == written['mtime_ns']
+
+    @classmethod
+    def mark_written(cls, entry, filename, date, state):
+        entry['written'] = {'state': state, 'datetime': date}
+        entry['written'].update(PictureUpdater.fingerprint(filename))
+
     def write_fixes(self, force=False):
         write_counter = 0
         file_counter = 0
-        progress = PrettyProgress(len(self.db))
         if not force:
             log.warning('not really writing files, use --force')
-        log.info('Processing %i files for update' % len(self.db))
+        log.info('Checking %i files for pending updates' % len(self.db))
+        pictures = {}
+        done_counter = 0
         for picture in self.db:
-            progress.step()
-            if self.EXIT.exit:
-                break
-
             if picture['datetime'] is None:
                 log.debug('not touching %s as no datetime in db' % picture['filename'])
                 continue
+            if PhotoData.timestamps(self.db.db[picture['filename']]).get('datetime') is None:
+                log.error('Not touching %s, datetime %s is not a valid datetime to format %s'
+                          % (picture['filename'], picture['datetime'], EXIF_DATETIME_FORMAT))
+                continue
             filename = os.path.join(self.dir, picture['filename'])
+            if PictureUpdater.is_written(self.db.db[picture['filename']], filename):
+                log.debug('%s already written' % filename)
+                done_counter = done_counter + 1
+                continue
+            pictures[filename] = picture
+        log.info('%i files already written, %i files pending update' % (done_counter, len(pictures)))
+
+        progress = PrettyProgress(len(pictures))
+        for filename in self.scheduler.schedule(list(pictures.keys())):
+            picture = pictures[filename]
+            entry = self.db.db[picture['filename']]
+            progress.step()
+            if self.EXIT.exit:
+                break
+
             date = picture['datetime']
-            try:
-                datetime.datetime.strptime(date, EXIF_DATETIME_FORMAT)
-            except ValueError:
-                log.error('Datetime % is not a valid datetime to format %s' % (date, EXIF_DATETIME_FORMAT))
-                sys.exit(1)
             log.debug('Updating %s' % filename)
 
             if os.path.isfile(filename):
@@ -766,6 +1627,8 @@ class PictureUpdater(object):
                         log.debug('Original file has exif')
                         if img.datetime == date:
                             log.debug('Image already on correct timestamp')
+                            if force:
+                                PictureUpdater.mark_written(entry, filename, date, 'ALREADY CORRECT')
                             continue
                 img.datetime = date
                 if 'datetime_original' in list(dir(img)):
@@ -778,6 +1641,7 @@ class PictureUpdater(object):
                         new_file.write(img.get_file())
                         new_file.close()
                         write_counter = write_counter + 1
+                    PictureUpdater.mark_written(entry, filename, date, 'WRITTEN')
             else:
                 log.warning('picture %s in db not on filesystem' % filename)
         progress.finish()
@@ -785,6 +1649,149 @@ class PictureUpdater(object):
         log.info('%i files needed updating' % file_counter)
         if force:
             log.info('%i files written' % write_counter)
+        return write_counter
+
+
+class PhotoDaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line)
+            response = self.server.photo_daemon.handle(request)
+        except ValueError as e:
+            response = {'ok': False, 'error': 'invalid request: %s' % e}
+        except Exception as e:
+            log.error('daemon request failed: %s' % e)
+            response = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+        self.wfile.write(('%s\n' % json.dumps(response)).encode('utf-8'))
+
+
+class PhotoDaemon(object):
+    # keeps the picture db in memory and answers json requests, one per line, on a unix socket
+
+    COMMANDS = ['list', 'issues', 'add', 'remove', 'fix']
+    SAVE_INTERVAL = 5
+
+    @classmethod
+    def request(cls, socket_file, request):
+        if not os.path.exists(socket_file):
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(socket_file)
+                s.sendall(('%s\n' % json.dumps(request)).encode('utf-8'))
+                line = s.makefile('rb').readline()
+                s.close()
+        except OSError as e:
+            log.debug('no daemon on %s: %s' % (socket_file, e))
+            return None
+        try:
+            return json.loads(line)
+        except ValueError:
+            return {'ok': False, 'error': 'no response from daemon, see daemon log'}
+
+    @classmethod
+    def request_from_args(cls, args, out_filter):
+        request = {'command': args.command}
+        if args.command in ['list', 'issues']:
+            request['prefix'] = args.prefix
+            request['filter'] = out_filter
+        if args.command == 'remove':
+            request.update({'name': args.name, 'regex': args.regex, 'prefix': args.prefix})
+        if args.command == 'add':
+            request.update({'name': args.name, 'force': args.force})
+        if args.command == 'fix':
+            patterns = None
+            if args.patterns is not None:
+                patterns = os.path.abspath(args.patterns)
+            request.update({'regex': args.regex, 'patterns': patterns, 'match_dir': args.match_dir})
+        return request
+
+    def __init__(self, photo_db, socket_file, save_interval=SAVE_INTERVAL):
+        self.photo_db = photo_db
+        self.photo_db.background_save = True
+        self.socket_file = socket_file
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def handle(self, request):
+        command = request.get('command')
+        log.info('daemon request %s' % command)
+        with self.lock:
+            photo_db = self.photo_db
+            try:
+                if command == 'ping':
+                    return {'ok': True, 'entries': len(photo_db)}
+                if command in ['list', 'issues']:
+                    if request.get('prefix') is not None:
+                        photo_db = photo_db.subtree(request['prefix'])
+                    if command == 'issues':
+                        photo_db = photo_db.problems()
+                    if request.get('filter'):
+                        photo_db = photo_db.filter(**request['filter'])
+                    return {'ok': True, 'files': photo_db.db}
+                if command == 'remove':
+                    photo_db.remove(filename=request.get('name'), regex=request.get('regex'),
+                                    dir_key=request.get('prefix'))
+                    return {'ok': True}
+                if command == 'add':
+                    photo_db.add(request['name'], force=request.get('force', False))
+                    return {'ok': True}
+                if command == 'fix':
+                    matcher = DateMatcher.create(regex=request.get('regex'), pattern_file=request.get('patterns'),
+                                                 match_dir=request.get('match_dir', False))
+                    photo_db.fix(matcher=matcher)
+                    return {'ok': True}
+            except (KeyError, OSError, ValueError, re.error) as e:
+                return {'ok': False, 'error': '%s' % e}
+            except SystemExit:
+                return {'ok': False, 'error': '%s failed, see daemon log' % command}
+            except Exception as e:
+                # e.g. unreadable exif in a file that is added, the daemon keeps serving
+                log.error('%s failed: %s' % (command, e))
+                return {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+        return {'ok': False, 'error': 'unknown command %s' % command}
+
+    def flush(self):
+        with self.lock:
+            if self.photo_db.dirty:
+                self.photo_db.dirty = False
+                self.photo_db.write()
+
+    def saver(self):
+        while not self.stopped.wait(self.save_interval):
+            self.flush()
+
+    def serve(self):
+        if PhotoDaemon.request(self.socket_file, {'command': 'ping'}) is not None:
+            log.error('A daemon is already serving on %s' % self.socket_file)
+            sys.exit(1)
+        if os.path.exists(self.socket_file):
+            log.debug('removing stale socket %s' % self.socket_file)
+            os.remove(self.socket_file)
+
+        server = socketserver.UnixStreamServer(self.socket_file, PhotoDaemonHandler)
+        server.photo_daemon = self
+        server.timeout = 1
+        saver = threading.Thread(target=self.saver, daemon=True)
+        saver.start()
+        log.info('Serving %i db entries on %s' % (len(self.photo_db), self.socket_file))
+        # requests are handled one by one in this thread, only saving runs in the background.
+        # the daemon owns SIGINT, the db objects made for requests share its CleanExit
+        clean_exit = CleanExit(own=True)
+        self.photo_db.clean_exit = clean_exit
+        try:
+            while not clean_exit.exit:
+                server.handle_request()
+        finally:
+            CleanExit.owned = False
+            server.server_close()
+            os.remove(self.socket_file)
+            self.stopped.set()
+            saver.join()
+            self.flush()
+        log.info('Daemon stopped')
 
 
 def get_parser():
@@ -792,21 +1799,26 @@ def get_parser():
     parser.add_argument('-v', '--verbose', help='debug output', action='store_true')
     parser.add_argument('--picture-database', help='picture db file', default='db.json')
     parser.add_argument('-d', '--dir', help='process entire dir', default=os.getenv('PHOTO_DIR', None))
+    parser.add_argument('--socket', help='daemon socket (default <picture database>.sock)')
+    parser.add_argument('--no-daemon', help='do not use a running daemon', action='store_true')
 
     command = parser.add_subparsers(dest='command', metavar='command', required=True)
 
     lister = command.add_parser('list', help='List the Picture Database')
     lister.add_argument('-o', '--out', help='output to csv')
     lister.add_argument('--filter', help='filter output with field=value,field2=value2,...')
+    lister.add_argument('--dir', help='only entries under this directory', dest='prefix')
 
     issues = command.add_parser('issues', help='list the problematic files in the Picture Database')
     issues.add_argument('-o', '--out', help='output to csv')
     issues.add_argument('--filter', help='filter output with field=value,field2=value2,...')
+    issues.add_argument('--dir', help='only entries under this directory', dest='prefix')
 
     remove = command.add_parser('remove', help='remove file(s) from Picture Database')
     selector = remove.add_mutually_exclusive_group(required=True)
     selector.add_argument('-n', '--name', help='filename selector')
     selector.add_argument('-r', '--regex', help='regex selector')
+    selector.add_argument('--dir', help='directory selector, removes everything under it', dest='prefix')
 
     add = command.add_parser('add', help='add single file to Picture Database')
     add.add_argument('-n', '--name', help='filename', required=True)
@@ -815,14 +1827,35 @@ def get_parser():
     scan = command.add_parser('scan', help='create picture database')
     scan.add_argument('--rebuild', help='rebuild existing db', action='store_true')
     scan.add_argument('--force', help='force file overwrite', action='store_true')
-
-    command.add_parser('map', help='map directory date db over file')
+    shard = scan.add_mutually_exclusive_group()
+    shard.add_argument('--shard', help='only scan files in shard K/N by path hash (K in 1..N)')
+    shard.add_argument('--subdir', help='only scan this subdirectory (repeatable)', action='append')
+    scan.add_argument('--low-memory', help='scan directory by directory and stream the db to disk',
+                      action='store_true')
+    scan.add_argument('--io-order', help='order of reading files (ignored with --low-memory)',
+                      choices=IOScheduler.ORDERS, default='none')
+    scan.add_argument('--prefetch', help='number of file headers to read ahead, for network mounts',
+                      type=int, default=0)
+    scan.add_argument('--read-latency', help='add seconds of latency to every read ahead (for testing)',
+                      type=float, default=0.0)
+
+    merge = command.add_parser('merge', help='merge partial picture databases')
+    merge.add_argument('-i', '--input', help='partial db file', nargs='+', required=True)
+    merge.add_argument('--force', help='force file overwrite', action='store_true')
+
+    mapper = command.add_parser('map', help='map directory date db over file')
+    mapper.add_argument('--interpolate', help='first interpolate dates between files in the same dir',
+                        action='store_true')
+
+    command.add_parser('upgrade', help='upgrade picture database to the current schema version')
 
     info = command.add_parser('info', help='get exif info')
     info.add_argument('-f', '--file', help='filename', required=True)
 
     fix = command.add_parser('fix', help='run fixes')
-    fix.add_argument('--regex', help='set regex to find dates in files', default=IMG_FILENAME_REGEX)
+    fix.add_argument('--regex', help='extra regex to find dates in file names')
+    fix.add_argument('--patterns', help='json file with a list of extra regexes to find dates in file names')
+    fix.add_argument('--match-dir', help='also look for dates in parent directory names', action='store_true')
 
     update = command.add_parser('update', help='update manual fixes from a issues csv')
     update.add_argument('-i', '--input', help='input issues.csv', required=True)
@@ -830,6 +1863,11 @@ def get_parser():
 
     write = command.add_parser('write', help='write fixed metadata to files')
     write.add_argument('--force', help='force update', action='store_true')
+    write.add_argument('--io-order', help='order of reading files', choices=IOScheduler.ORDERS, default='none')
+
+    serve = command.add_parser('serve', help='keep the Picture Database in memory and serve requests')
+    serve.add_argument('--save-interval', help='seconds between saving changes', type=int,
+                       default=PhotoDaemon.SAVE_INTERVAL)
 
     return parser.parse_args()
 
@@ -860,22 +1898,89 @@ def main():
     except AttributeError:
         pass
 
+    r = re.compile('^%s' % os.path.join(args.dir, ''))
+    try:
+        if args.prefix is not None:
+            args.prefix = PathIndex.normalize(r.sub('', args.prefix))
+    except AttributeError:
+        pass
+    try:
+        if args.subdir is not None:
+            args.subdir = [PathIndex.normalize(r.sub('', d)) for d in args.subdir]
+    except AttributeError:
+        pass
+
+    socket_file = args.socket
+    if socket_file is None:
+        socket_file = '%s.sock' % args.picture_database
+    if not args.no_daemon:
+        if args.command in PhotoDaemon.COMMANDS:
+            response = PhotoDaemon.request(socket_file, PhotoDaemon.request_from_args(args, out_filter))
+            if response is not None:
+                log.debug('request handled by daemon on %s' % socket_file)
+                if not response['ok']:
+                    log.error('Daemon: %s' % response['error'])
+                    sys.exit(1)
+                if 'files' in response.keys():
+                    photo_db = PhotoData(args.dir, response['files'], db_file='')
+                    if args.out is not None:
+                        photo_db.csv_write(args.out)
+                    else:
+                        print('%s' % photo_db)
+                return
+        elif PhotoDaemon.request(socket_file, {'command': 'ping'}) is not None:
+            log.error('A daemon is serving %s on %s, stop it first' % (args.picture_database, socket_file))
+            sys.exit(1)
+
     if args.command == 'scan':
         if os.path.isfile(args.picture_database):
             log.warning('DB already exists')
             if not args.force:
                 log.error('Not overwriting (use --force)')
                 sys.exit(1)
+        shard = None
+        if args.shard is not None:
+            try:
+                shard = tuple(int(i) for i in args.shard.split('/'))
+                if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+                    raise ValueError()
+            except ValueError:
+                log.error('Invalid shard %s, use K/N with 1 <= K <= N' % args.shard)
+                sys.exit(1)
         log.info('Creating picture database for %s' % args.dir)
-        photo_db = PhotoData.scan(args.dir, args.picture_database, rebuild=args.rebuild)
-        photo_db.save()
+        reader = HeaderReader(args.prefetch, latency=args.read_latency)
+        if args.low_memory:
+            if args.io_order != 'none':
+                log.warning('--io-order is ignored with --low-memory, files are read in path order')
+            PhotoData.scan_bounded(args.dir, args.picture_database, rebuild=args.rebuild,
+                                   shard=shard, subdirs=args.subdir, reader=reader)
+        else:
+            photo_db = PhotoData.scan(args.dir, args.picture_database, rebuild=args.rebuild,
+                                      shard=shard, subdirs=args.subdir, io_order=args.io_order, reader=reader)
+            photo_db.save()
+    elif args.command == 'merge':
+        if os.path.isfile(args.picture_database):
+            log.warning('DB already exists')
+            if not args.force:
+                log.error('Not overwriting (use --force)')
+                sys.exit(1)
+        for partial in args.input:
+            if not os.path.isfile(partial):
+                log.error('No partial picture database %s found' % partial)
+                sys.exit(1)
+        PhotoData.merge(args.dir, args.input, args.picture_database)
     else:
         if not os.path.isfile(args.picture_database):
             log.error('No picture database %s found. Run scan first' % args.picture_database)
             sys.exit(1)
         photo_db = PhotoData.load(args.dir, args.picture_database)
 
+        if args.command == 'upgrade':
+            log.info('Picture database %s is at schema version %i' % (args.picture_database, DB_SCHEMA_VERSION))
+
         if args.command == 'list':
+            if args.prefix is not None:
+                photo_db = photo_db.subtree(args.prefix)
             if args.filter is not None:
                 photo_db = photo_db.filter(**out_filter)
             if args.out is not None:
@@ -883,6 +1988,8 @@ def main():
             else:
                 print('%s' % photo_db)
         if args.command == 'issues':
+            if args.prefix is not None:
+                photo_db = photo_db.subtree(args.prefix)
             p = photo_db.problems()
             if args.filter is not None:
                 p = p.filter(**out_filter)
@@ -891,18 +1998,35 @@ def main():
             else:
                 p.csv_write(args.out)
         if args.command == 'remove':
-            photo_db.remove(filename=args.name, regex=args.regex)
+            photo_db.remove(filename=args.name, regex=args.regex, dir_key=args.prefix)
         if args.command == 'map':
+            if args.interpolate:
+                photo_db.interpolate()
             photo_db.dir_date_map()
         if args.command == 'fix':
-            photo_db.fix(regex=args.regex)
+            try:
+                matcher = DateMatcher.create(regex=args.regex, pattern_file=args.patterns, match_dir=args.match_dir)
+            except (OSError, ValueError, re.error) as e:
+                log.error('Invalid date pattern: %s' % e)
+                sys.exit(1)
+            photo_db.fix(matcher=matcher)
         if args.command == 'update':
             photo_db.update_from_file(args.input, force=args.force)
         if args.command == 'write':
             problems = photo_db.problems()
-            PictureUpdater(problems, path=str(args.dir)).write_fixes(force=args.force)
+            PictureUpdater(problems, path=str(args.dir), io_order=args.io_order).write_fixes(force=args.force)
+            if args.force:
+                # keep the written state, also after CTRL-C so a next run skips what is done
+                photo_db.can_save = True
+                photo_db.save()
         if args.command == 'add':
-            photo_db.add(args.name, force=args.force)
+            try:
+                photo_db.add(args.name, force=args.force)
+            except ValueError as e:
+                log.error('%s' % e)
+                sys.exit(1)
+        if args.command == 'serve':
+            PhotoDaemon(photo_db, socket_file, save_interval=args.save_interval).serve()
 
 
 if '__main__' in __name__:
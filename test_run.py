@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import run
+
+
+class WalkSortedTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name in ['a/x.jpg', 'a/c/x.jpg', 'a-b/x.jpg', 'ab/x.jpg', 'z.jpg']:
+            os.makedirs(os.path.dirname(os.path.join(self.path, name)), exist_ok=True)
+            open(os.path.join(self.path, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_whole_tree_in_key_order(self):
+        keys = list(run.PhotoData.walk_sorted(self.path))
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), 5)
+
+    def test_sibling_subdirs_in_key_order(self):
+        keys = list(run.PhotoData.walk_sorted(self.path, ['a', 'a-b']))
+        self.assertEqual(keys, ['a-b/x.jpg', 'a/c/x.jpg', 'a/x.jpg'])
+
+    def test_nested_subdirs_walked_once(self):
+        keys = list(run.PhotoData.walk_sorted(self.path, ['a/c', 'a', 'a-b', 'a/c/']))
+        self.assertEqual(keys, ['a-b/x.jpg', 'a/c/x.jpg', 'a/x.jpg'])
+
+    def test_scan_nested_subdirs_listed_once(self):
+        self.assertEqual(run.PhotoData.scan_roots(['a/c', 'a', 'a-b', 'a/c/']), ['a-b', 'a'])
+        self.assertEqual(run.PhotoData.scan_roots(None), [''])
+
+
+class DateMatcherTest(unittest.TestCase):
+    def test_pattern_with_time_wins_over_earlier_date(self):
+        matcher = run.DateMatcher.create()
+        self.assertEqual(matcher.match('2017-06-02 20190301_142233.jpg'), '2019:03:01 14:22:33')
+
+    def test_invalid_leftmost_date_is_skipped(self):
+        matcher = run.DateMatcher.create()
+        self.assertEqual(matcher.match('99999999 IMG_20180704.jpg'), '2018:07:04 12:00:00')
+
+    def test_user_pattern_first(self):
+        matcher = run.DateMatcher.create(regex=r'(?P<day>[0-9]{2})\.(?P<month>[0-9]{2})\.(?P<year>[0-9]{4})')
+        self.assertEqual(matcher.match('2017-06-02 04.07.2018.jpg'), '2018:07:04 12:00:00')
+
+    def test_hour_without_seconds(self):
+        matcher = run.DateMatcher.create(
+            regex=r'(?P<year>[0-9]{4})(?P<month>[0-9]{2})(?P<day>[0-9]{2})_(?P<hour>[0-9]{2})h(?P<minute>[0-9]{2})')
+        self.assertEqual(matcher.match('20180704_10h22.jpg'), '2018:07:04 10:22:00')
+        matcher = run.DateMatcher.create(regex=r'([0-9]{4})([0-9]{2})([0-9]{2})_([0-9]{2})h([0-9]{2})')
+        self.assertEqual(matcher.match('20180704_10h22.jpg'), '2018:07:04 10:22:00')
+
+
+if __name__ == '__main__':
+    unittest.main()